@@ -1,15 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import time
 from datetime import datetime
 import os
 import io
-import tempfile
-import json
+import orjson
 import re
 import uuid
+import hashlib
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 import pdfplumber
+import pypdfium2 as pdfium
 from langchain_ollama import ChatOllama
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ==============================================================================
 # 1. CONFIGURATION & SETUP
@@ -17,6 +23,11 @@ from langchain_ollama import ChatOllama
 
 # --- App Constants ---
 APP_TITLE = "Solar Customs AI"
+LAYOUT_SECTION_MARKER = "J. PROCESS DETAILS"
+TEXT_QUALITY_MARKER = "SB NO"  # Absent from the fast PDFium text -> re-extract with pdfplumber
+MAX_WORKERS = 8  # Concurrent AI calls in flight (bounded by the AI server's parallel decode slots)
+BATCH_CHAR_BUDGET = 20_000  # ~7k prompt tokens; with ~2k tokens per reply a full batch fits LLM_NUM_CTX
+BATCH_MAX_DOCS = 4
 FINAL_COLUMNS = [
     "Sr. No.",
     "SB NO.",
@@ -60,13 +71,22 @@ TRUST_BLUE = "#ffffff"
 SOLAR_RED = "#CD001E"
 
 # --- LLM SETUP ---
+# Run `ollama show qwen2.5vl:32b` on the server and check "quantization": the library tag should be
+# Q4_K_M. If it reports F16/BF16 or Q8_0, pull or create a Q4_K_M build and point LLM_MODEL at it.
+LLM_MODEL = "qwen2.5vl:32b"
+LLM_BASE_URL = "http://172.17.54.24:11434"
+# One fixed window for single-file and batched calls alike: Ollama reloads the model whenever a
+# request's num_ctx differs from the loaded runner's, which costs far more than a smaller KV cache saves.
+# Sized for the largest call, a full batch: BATCH_CHAR_BUDGET / ~3 chars per token (~6.7k) + the rules
+# (~1k) + BATCH_MAX_DOCS replies of ~2k tokens each is ~15.7k. Keep it in step with those two constants.
+LLM_NUM_CTX = 16384
+
 @st.cache_resource
 def init_llm():
     try:
         return ChatOllama(
-            model="qwen2.5vl:32b", temperature=0.1, num_ctx=32768, format="json",
-            base_url="http://172.17.54.24:11434"
-            
+            model=LLM_MODEL, temperature=0.1, num_ctx=LLM_NUM_CTX, format="json",
+            base_url=LLM_BASE_URL
         )
     except Exception as e:
         st.error(f"Failed to initialize AI Model. Is the server running? Error: {e}")
@@ -78,142 +98,313 @@ llm = init_llm()
 # 2. BACKEND DATA PROCESSING FUNCTIONS
 # ==============================================================================
 
+_NUM_RE = re.compile(r'[^\d.-]')
+_TRAILING_SPACE_RE = re.compile(r'[ \t\r]+$', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{2,}')
+
 def clean_number(value):
-    if not value: return 0.0
     if isinstance(value, (int, float)): return float(value)
-    clean_str = re.sub(r'[^\d.-]', '', str(value))
-    try: return float(clean_str)
-    except: return 0.0
-
-def extract_pdf_text(pdf_bytes):
-    full_text = ""
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-        tmp.write(pdf_bytes); tmp.flush(); tmp_path = tmp.name
+    if not value: return 0.0
+    try: return float(_NUM_RE.sub('', str(value)))
+    except ValueError: return 0.0
+
+@st.cache_resource
+def _parse_pool():
+    """Worker processes for PDF parsing, which is CPU-bound and GIL-limited on threads.
+    Kept across reruns. Spawned workers re-import this script, hence the __main__ guard on main()."""
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+def _submit_parse(pdf_bytes):
+    try: return _parse_pool().submit(_parse_pdf_text, pdf_bytes)
+    except BrokenProcessPool:
+        # A worker died earlier (PDFium is C code and can crash on a malformed PDF),
+        # which breaks the cached pool for good: replace it with a fresh one
+        _parse_pool.clear()
+        return _parse_pool().submit(_parse_pdf_text, pdf_bytes)
+
+def _resubmit_broken(pending, blob_by_sha):
+    """Resubmits every parse lost to a broken pool (a worker died) to a fresh pool in one go,
+    so the retries run in parallel. Parses that already finished keep their result."""
+    for pdf_sha, item in pending.items():
+        if isinstance(item, Future) and isinstance(item.exception(), BrokenProcessPool):
+            pending[pdf_sha] = _submit_parse(blob_by_sha[pdf_sha])
+
+@st.cache_data(max_entries=200, show_spinner=False)
+def _cached_pdf_text(pdf_sha, _text=None):
+    """PDF text memoized on the file's SHA-256, so reruns and retries skip parsing.
+    Called with only the digest it is a lookup (LookupError on a miss); passing `_text`
+    (excluded from hashing) stores freshly parsed text under that digest."""
+    if _text is None: raise LookupError(pdf_sha)
+    return _text
+
+def extract_pdf_texts(blob_by_sha):
+    """Yields (sha, text) for each PDF in upload order, so batches are formed the same way for
+    the same files. Cached text is served directly and only misses are sent to the worker
+    processes. Runs on the script thread, keeping the AI thread pool free."""
+    pending = {}
+    for pdf_sha, pdf_bytes in blob_by_sha.items():
+        try: pending[pdf_sha] = _cached_pdf_text(pdf_sha)
+        except LookupError: pending[pdf_sha] = _submit_parse(pdf_bytes)
+    retried = False
+    for pdf_sha in pending:
+        text = pending[pdf_sha]
+        if isinstance(text, Future):
+            try: text = text.result()
+            except BrokenProcessPool:
+                # Retry once in a fresh pool; a PDF that breaks that one too is skipped as unreadable
+                if not retried:
+                    retried = True
+                    _resubmit_broken(pending, blob_by_sha)
+                try: text = pending[pdf_sha].result()
+                except BrokenProcessPool: text = ""
+            if text: _cached_pdf_text(pdf_sha, text)
+        yield pdf_sha, text
+
+def _parse_pdf_text(pdf_bytes):
+    """Fast path: PDFium (C library) text, several times faster than pdfplumber.
+    Falls back to pdfplumber when the result doesn't look like a Shipping Bill."""
     try:
-        with pdfplumber.open(tmp_path) as pdf:
-            for page in pdf.pages:
-                full_text += page.extract_text(layout=True) or ""
-    finally:
-        try: os.remove(tmp_path)
-        except: pass
-    return full_text
-
-def get_hierarchical_json(text):
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try: pages = [page.get_textpage().get_text_range() for page in pdf]
+        finally: pdf.close()
+    except pdfium.PdfiumError:
+        pages = []
+    if TEXT_QUALITY_MARKER not in "\n".join(pages).upper():
+        # Corrupt or encrypted PDFs raise here too (pdfminer syntax/password errors): treat as unreadable
+        try: return _extract_text_pdfplumber(pdf_bytes)
+        except Exception: return ""
+    # PDFium has no layout mode: re-extract just the LEO Date grid page (section J) with pdfplumber
+    for i, page_text in enumerate(pages):
+        if LAYOUT_SECTION_MARKER in page_text:
+            try:
+                with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+                    pages[i] = pdf.pages[i].extract_text(layout=True) or page_text
+            except Exception: pass  # Keep PDFium's plain text for this page
+            break
+    return "\n".join(pages)
+
+def _extract_text_pdfplumber(pdf_bytes):
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        # Plain reading-order text is enough for the AI; layout=True is several times slower
+        parts = [page.extract_text() or "" for page in pdf.pages]
+        # Keep visual alignment only on the page holding the LEO Date grid (section J)
+        for i, part in enumerate(parts):
+            if LAYOUT_SECTION_MARKER in part:
+                parts[i] = pdf.pages[i].extract_text(layout=True) or part
+                break
+    return "\n".join(parts)
+
+# Static instructions go in the system message: the prefix is identical on every call,
+# so the AI server can reuse it, and only the document text changes per request.
+EXTRACTION_RULES = """You are a Customs Data Specialist. Parse this Shipping Bill into a strictly hierarchical JSON.
+CRITICAL MAPPING RULES:
+1. CUSTOMER NAME (CRITICAL):
+   - GO TO SECTION: "Part I" or Header Details.
+   - LOCATE FIELD: "Buyer Name" or "Buyer Details".
+   - EXTRACT: The Name of the Buyer.
+   - EXCLUDE: Do NOT extract "Exporter" or "Consignee" (unless Consignee is the same as Buyer). We strictly need the BUYER NAME.
+2. LEO DATE (CRITICAL - DD-MMM-YYYY format):
+   - LOCATE RELEVANT SECTION: Scan for "J. PROCESS DETAILS" (usually bottom-left quadrant, y ≈ 85%). Restrict parsing to this block.
+   - ENTITY EXTRACTION & VALIDATION (Two-Pointer Method):
+     - Strategy A (Key-Value Pair Mapping):
+       - Search Pattern: Locate label "6. LEO Date." (or similar).
+       - Fetch: Extract value from immediate sibling cell to the right.
+     - Strategy B (Grid/Table Intersection):
+       - Identify Column Index: "2. DATE".
+       - Identify Row Index: "9. LEO" (or "Let Export Order").
+       - Fetch: Extract value from the intersection of this row and column.
+     - Validation: Cross-reference Strategy A and Strategy B. If they match, use that date. If they differ, prefer the date from "6. LEO Date.".
+   - FINAL EXTRACT: The validated Date portion ONLY in DD-MMM-YYYY format (e.g., 10-MAY-25). Ignore timestamps or status.
+3. S/B Date: Extract the date in DD-MMM-YYYY format.
+4. PORT CODE: Extract the "Port of Loading" (Origin) from Page 1 header.
+5. INVOICES (Part II):
+   - FINAL INVOICE NO: Extract the cleaner/fuller version if available, or just the number.
+   - Extract "3.FREIGHT" and "4.INSURANCE" (Total amounts in Foreign Currency).
+   - Extract "Exchange Rate".
+6. ITEMS (Part III):
+   - PRODUCT GROUP: Extract the COMPLETE "Item Description" text. Do NOT truncate or summarize. Copy it exactly as it appears.
+   - FOB VALUE: Extract strictly from "Part III - ITEM DETAILS". Look for the column "FOB (INR)" or "9.FOB". Use this declared value.
+   - SCHEME CODE: Look for column "18.SCHCOD" or similar in Part III, or the Scheme Code in Part IV (e.g., "19").
+7. SCHEMES (Part IV):
+   - Match Item Serial Nos to find Drawback and RoDTEP amounts.
+JSON OUTPUT FORMAT:
+{
+  "shipping_bill_header": {"SB NO.": "string", "S/B Date": "string", "LEO Date": "string", "PORT CODE": "string", "CUSTOMER NAME": "string", "COUNTRY": "string", "SB_TYPE": "string"},
+  "invoices": [{ "FINAL INVOICE NO": "string", "INCOTERMS": "string", "Currency of export": "string", "Custom Exchange Rate in FC": "number", "FREIGHT_TOTAL_FC": "number", "INSURANCE_TOTAL_FC": "number",
+      "items": [{ "H.S. Itch code": "string", "PRODUCT GROUP": "string", "Qty": "number", "Unit": "string", "FOB Value as per SB in INR": "number", "SCHEME_CODE": "string", "SCHEME_NAME": "string", "DRAWBACK Receivable on fob": "number", "RoDTEP RECEIVABLE": "number"}]
+  }]
+}
+
+Output ONLY valid JSON. No markdown fencing.
+"""
+BATCH_INSTRUCTIONS = ('The text below contains {count} separate Shipping Bills. Apply the rules to each one and return '
+                      '{{"documents": [...]}} with exactly {count} objects in the JSON OUTPUT FORMAT, in document order.')
+# Part of every AI cache key: a new model or prompt must not serve results cached from the old one
+EXTRACTION_VERSION = f"{LLM_MODEL}:{hashlib.sha256((EXTRACTION_RULES + BATCH_INSTRUCTIONS).encode()).hexdigest()[:12]}"
+
+def _compact_text(text):
+    """Drops trailing padding and blank lines that only cost prompt tokens. Runs of spaces
+    inside a line are kept: they carry the column alignment of the layout page (section J)."""
+    text = _TRAILING_SPACE_RE.sub('', text)
+    return _BLANK_LINES_RE.sub('\n', text).strip('\n')
+
+def _stream_json(client, messages, on_chunk=None):
+    """Streams an AI response (so progress is visible while it arrives) and parses it as JSON."""
+    chunks, received = [], 0
+    for chunk in client.stream(messages):
+        chunks.append(chunk.content)
+        received += len(chunk.content)
+        if on_chunk: on_chunk(received)
+    content = "".join(chunks)
+    clean_json = content.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    return orjson.loads(clean_json)
+
+def get_hierarchical_json(text, on_chunk=None):
     if not llm: return None
-    prompt = f"""
-    You are a Customs Data Specialist. Parse this Shipping Bill into a strictly hierarchical JSON.
-
-    **CRITICAL MAPPING RULES:**
-    
-    1. **CUSTOMER NAME (CRITICAL)**:
-       - GO TO SECTION: "Part I" or Header Details.
-       - LOCATE FIELD: "Buyer Name" or "Buyer Details".
-       - EXTRACT: The Name of the Buyer.
-       - EXCLUDE: Do NOT extract "Exporter" or "Consignee" (unless Consignee is the same as Buyer). We strictly need the BUYER NAME.
-    
-    2. **LEO DATE (CRITICAL - DD-MMM-YYYY format)**:
-       - **LOCATE RELEVANT SECTION**: Scan for "J. PROCESS DETAILS" (usually bottom-left quadrant, y ≈ 85%). Restrict parsing to this block.
-       - **ENTITY EXTRACTION & VALIDATION (Two-Pointer Method)**:
-         - **Strategy A (Key-Value Pair Mapping)**:
-           - Search Pattern: Locate label "6. LEO Date." (or similar).
-           - Fetch: Extract value from immediate sibling cell to the right.
-         - **Strategy B (Grid/Table Intersection)**:
-           - Identify Column Index: "2. DATE".
-           - Identify Row Index: "9. LEO" (or "Let Export Order").
-           - Fetch: Extract value from the intersection of this row and column.
-         - **Validation**: Cross-reference Strategy A and Strategy B. If they match, use that date. If they differ, prefer the date from "6. LEO Date.".
-       - **FINAL EXTRACT**: The validated Date portion ONLY in DD-MMM-YYYY format (e.g., 10-MAY-25). Ignore timestamps or status.
-
-    3. **S/B Date**: Extract the date in DD-MMM-YYYY format.
-       
-    4. **PORT CODE**: Extract the "Port of Loading" (Origin) from Page 1 header.
-    
-    5. **INVOICES (Part II)**: 
-       - **FINAL INVOICE NO**: Extract the cleaner/fuller version if available, or just the number.
-       - Extract "3.FREIGHT" and "4.INSURANCE" (Total amounts in Foreign Currency).
-       - Extract "Exchange Rate".
-       
-    6. **ITEMS (Part III)**: 
-       - **PRODUCT GROUP**: Extract the COMPLETE "Item Description" text. Do NOT truncate or summarize. Copy it exactly as it appears.
-       - **FOB VALUE**: Extract strictly from "Part III - ITEM DETAILS". Look for the column "FOB (INR)" or "9.FOB". Use this declared value.
-       - **SCHEME CODE**: Look for column "18.SCHCOD" or similar in Part III, or the Scheme Code in Part IV (e.g., "19"). 
-       
-    7. **SCHEMES (Part IV)**: 
-       - Match Item Serial Nos to find Drawback and RoDTEP amounts.
-
-    **JSON OUTPUT FORMAT:**
-    {{
-      "shipping_bill_header": {{"SB NO.": "string", "S/B Date": "string", "LEO Date": "string", "PORT CODE": "string", "CUSTOMER NAME": "string", "COUNTRY": "string", "SB_TYPE": "string"}},
-      "invoices": [{{ "FINAL INVOICE NO": "string", "INCOTERMS": "string", "Currency of export": "string", "Custom Exchange Rate in FC": "number", "FREIGHT_TOTAL_FC": "number", "INSURANCE_TOTAL_FC": "number",
-          "items": [{{ "H.S. Itch code": "string", "PRODUCT GROUP": "string", "Qty": "number", "Unit": "string", "FOB Value as per SB in INR": "number", "SCHEME_CODE": "string", "SCHEME_NAME": "string", "DRAWBACK Receivable on fob": "number", "RoDTEP RECEIVABLE": "number"}}]
-      }}]
-    }}
-
-    **DOCUMENT TEXT:**
-    {text}
-    
-    ⚠️ Output ONLY valid JSON. No markdown fencing.
-    """
+    text = _compact_text(text)
+    messages = [
+        ("system", EXTRACTION_RULES),
+        ("human", f"DOCUMENT TEXT:\n{text}\n\nOutput JSON only."),
+    ]
     try:
-        resp = llm.invoke(prompt)
-        content = resp.content if hasattr(resp, "content") else resp
-        clean_json = content.replace("```json", "").replace("```", "").strip()
-        return json.loads(clean_json)
+        return _stream_json(llm, messages, on_chunk)
     except Exception as e:
         st.error(f"AI parsing failed. The document might be unreadable or have an unusual format. Error: {e}")
         return None
 
+def _is_document(data):
+    """True for a Shipping Bill object in the JSON OUTPUT FORMAT (anything else must not be cached)."""
+    return isinstance(data, dict) and "invoices" in data
+
+def get_hierarchical_json_batch(texts, on_chunk=None):
+    """Extracts several Shipping Bills in one AI call, sharing a single prefill.
+    Returns one dict per text (in order), or None so the caller can retry file by file."""
+    texts = [_compact_text(t) for t in texts]
+    docs = "".join(f"\n\n=== DOCUMENT {i} ===\n\n{t}" for i, t in enumerate(texts, start=1))
+    if not llm: return None
+    messages = [
+        ("system", EXTRACTION_RULES),
+        ("human", f"{BATCH_INSTRUCTIONS.format(count=len(texts))}{docs}\n\nOutput JSON only."),
+    ]
+    try:
+        documents = _stream_json(llm, messages, on_chunk).get("documents")
+    except Exception:
+        return None
+    if not isinstance(documents, list) or len(documents) != len(texts): return None
+    # Anything that isn't a full Shipping Bill object sends the batch down the per-file path
+    if not all(_is_document(d) for d in documents): return None
+    # Each result gets cached under its own file's digest, so it must provably belong to that
+    # file: its SB number has to appear in the matching source text (guards against reordering)
+    for document, text in zip(documents, texts):
+        header = document.get("shipping_bill_header")
+        sb_no = str(header.get("SB NO.") or "").strip() if isinstance(header, dict) else ""
+        if not sb_no or sb_no not in text: return None
+    return documents
+
+@st.cache_data(show_spinner=False, persist="disk", max_entries=500)
+def _extract_cached(pdf_sha, version, _text=None, _on_chunk=None, _document=None):
+    """AI extraction memoized on the PDF's SHA-256, so re-uploads skip the LLM.
+    Underscored args are excluded from Streamlit's hashing; the digest plus EXTRACTION_VERSION is the key.
+    Called with only the digest and version it is a lookup (LookupError on a miss); `_document` stores
+    a result that came from a batched call."""
+    if _document is not None: return _document
+    if _text is None: raise LookupError(pdf_sha)
+    json_data = get_hierarchical_json(_text, _on_chunk)
+    if not _is_document(json_data):
+        # Raising keeps failed extractions out of the cache so they are retried next time
+        raise ValueError("No data extracted from PDF")
+    return json_data
+
+def _skip_cached(parsed, rows_by_sha):
+    """Flattens PDFs whose AI result is already cached into `rows_by_sha` and yields only
+    the (sha, text) pairs that still need an AI call."""
+    for pdf_sha, text in parsed:
+        try: document = _extract_cached(pdf_sha, EXTRACTION_VERSION)
+        except LookupError:
+            yield pdf_sha, text
+            continue
+        # Never trust the disk cache blindly: a malformed entry is skipped rather than crashing the run
+        rows_by_sha[pdf_sha] = flatten_to_excel_rows(document) if _is_document(document) else None
+
+def _group_batches(documents):
+    """Groups (sha, text) pairs into AI batches under the prompt budget. Batches are yielded as
+    soon as they fill up, so the AI can start while later PDFs are still parsing. Empty texts are left out."""
+    batch, size = [], 0
+    for pdf_sha, text in documents:
+        if not text: continue
+        if batch and (size + len(text) > BATCH_CHAR_BUDGET or len(batch) == BATCH_MAX_DOCS):
+            yield batch
+            batch, size = [], 0
+        batch.append((pdf_sha, text))
+        size += len(text)
+    if batch: yield batch
+
 def flatten_to_excel_rows(hierarchical_data):
-    flat_rows = []
+    """Flattens one Shipping Bill into a DataFrame with one row per item.
+    Values are gathered column-wise and derived columns are computed with NumPy."""
     header = hierarchical_data.get("shipping_bill_header", {})
-    invoices = hierarchical_data.get("invoices", [])
-    
-    for inv in invoices:
-        items = inv.get("items", [])
-        item_count = len(items) if len(items) > 0 else 1
-        
-        ex_rate = clean_number(inv.get("Custom Exchange Rate in FC"))
-        currency = inv.get("Currency of export", "USD")
-        
-        for item in items:
-            fob_inr = clean_number(item.get("FOB Value as per SB in INR"))
-            qty = clean_number(item.get("Qty"))
-            dbk_amt = clean_number(item.get("DRAWBACK Receivable on fob"))
-            rodtep_amt = clean_number(item.get("RoDTEP RECEIVABLE"))
-            
-            fob_fc = (fob_inr / ex_rate) if ex_rate > 0 else 0
-            
-            rodtep_pct = (rodtep_amt / fob_inr * 100) if fob_inr > 0 else 0
-            dbk_pct = (dbk_amt / fob_inr * 100) if fob_inr > 0 else 0
-            
-            # Get the full description
-            description = item.get("PRODUCT GROUP", "").strip()
+    invoice_no, incoterms, currency, ex_rate = [], [], [], []
+    hs_code, description, qty, unit, fob_inr, dbk_amt, rodtep_amt = [], [], [], [], [], [], []
+
+    for inv in hierarchical_data.get("invoices", []):
+        inv_ex_rate = clean_number(inv.get("Custom Exchange Rate in FC"))
+        for item in inv.get("items", []):
+            invoice_no.append(inv.get("FINAL INVOICE NO", ""))
+            incoterms.append(inv.get("INCOTERMS", ""))
+            currency.append(inv.get("Currency of export", "USD"))
+            ex_rate.append(inv_ex_rate)
+            hs_code.append(item.get("H.S. Itch code", ""))
+            description.append(item.get("PRODUCT GROUP", "").strip())
+            qty.append(clean_number(item.get("Qty")))
+            unit.append(item.get("Unit", ""))
+            fob_inr.append(clean_number(item.get("FOB Value as per SB in INR")))
+            dbk_amt.append(clean_number(item.get("DRAWBACK Receivable on fob")))
+            rodtep_amt.append(clean_number(item.get("RoDTEP RECEIVABLE")))
+
+    if not fob_inr: return pd.DataFrame(columns=FINAL_COLUMNS)
+
+    ex_rate, fob_inr = np.array(ex_rate, dtype=float), np.array(fob_inr, dtype=float)
+    dbk_amt, rodtep_amt = np.array(dbk_amt, dtype=float), np.array(rodtep_amt, dtype=float)
+    zeros = np.zeros_like(fob_inr)
+    fob_fc = np.divide(fob_inr, ex_rate, out=zeros.copy(), where=ex_rate > 0)
+    dbk_pct = np.divide(dbk_amt * 100, fob_inr, out=zeros.copy(), where=fob_inr > 0)
+    rodtep_pct = np.divide(rodtep_amt * 100, fob_inr, out=zeros.copy(), where=fob_inr > 0)
+
+    # Scalars (SB header fields) broadcast across all item rows
+    return pd.DataFrame({
+        "Sr. No.": "", "SB NO.": header.get("SB NO.", ""), "S/B Date": header.get("S/B Date", ""),
+        "LEO Date": header.get("LEO Date", ""), "Customer Name": header.get("CUSTOMER NAME", ""),
+        "Final Invoice No.": invoice_no,
+        "SB – Solar / Other Goods": description, # Value is the full description
+        "Port Code": header.get("PORT CODE", ""), "Incoterms": incoterms,
+        "Country": header.get("COUNTRY", ""), "H.S. ITC (HS Code)": hs_code,
+        "Product Group": description, # Value is the full description
+        "Qty": qty, "Unit": unit,
+        "FOB Value Declared by Us (S/B) in FC": fob_fc.round(2), "Currency of Export": currency,
+        "Custom Exchange Rate (in FC)": ex_rate, "LEO Date Exchange Rate (in FC)": ex_rate,
+        "FOB Value as per SB in INR": fob_inr.round(2), "FOB Value as per LEO Ex. Rate in INR": fob_inr.round(2),
+        "Scheme (ADV/DFIA/Drawback)": "DRAWBACK", # Default value
+        "DBK %": np.char.mod("%.2f", dbk_pct), "Drawback Receivable on FOB": dbk_amt.round(2),
+        "RoDTEP %": np.char.mod("%.2f", rodtep_pct),
+        "RoDTEP Receivable": rodtep_amt.round(2), "RoDTEP Y/N": np.where(rodtep_amt > 0, "Yes", "No"),
+        "Balance RoDTEP": rodtep_amt.round(2),
+    }, columns=FINAL_COLUMNS)
+
+@st.cache_data(show_spinner=False, max_entries=10)
+def _to_xlsx(df):
+    """Excel export bytes, rebuilt only when the DataFrame changes (not on every rerun).
+    xlsxwriter is much faster than openpyxl; its constant_memory mode is not used because
+    pandas writes cells column by column, which that mode silently drops."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="xlsxwriter") as writer:
+        df.to_excel(writer, index=False, sheet_name='ShippingBills')
+    return buffer.getvalue()
 
-            # Set values based on new user rules
-            final_scheme = "DRAWBACK"
-            product_group_val = description
-            sb_type = description
-            
-            row = {
-                "Sr. No.": "", "SB NO.": header.get("SB NO.", ""), "S/B Date": header.get("S/B Date", ""),
-                "LEO Date": header.get("LEO Date", ""), "Customer Name": header.get("CUSTOMER NAME", ""),
-                "Final Invoice No.": inv.get("FINAL INVOICE NO", ""), 
-                "SB – Solar / Other Goods": sb_type, # Value is now the full description
-                "Port Code": header.get("PORT CODE", ""), "Incoterms": inv.get("INCOTERMS", ""),
-                "Country": header.get("COUNTRY", ""), "H.S. ITC (HS Code)": item.get("H.S. Itch code", ""),
-                "Product Group": product_group_val, # Value is the full description
-                "Qty": qty, "Unit": item.get("Unit", ""),
-                "FOB Value Declared by Us (S/B) in FC": round(fob_fc, 2), "Currency of Export": currency,
-                "Custom Exchange Rate (in FC)": ex_rate, "LEO Date Exchange Rate (in FC)": ex_rate, 
-                "FOB Value as per SB in INR": round(fob_inr, 2), "FOB Value as per LEO Ex. Rate in INR": round(fob_inr, 2),
-                "Scheme (ADV/DFIA/Drawback)": final_scheme, # Default value "DRAWBACK"
-                "DBK %": f"{dbk_pct:.2f}", "Drawback Receivable on FOB": round(dbk_amt, 2),
-                "RoDTEP %": f"{rodtep_pct:.2f}",
-                "RoDTEP Receivable": round(rodtep_amt, 2), "RoDTEP Y/N": "Yes" if rodtep_amt > 0 else "No",
-                "Balance RoDTEP": round(rodtep_amt, 2),
-            }
-            flat_rows.append(row)
-    return flat_rows
+@st.cache_data(show_spinner=False, max_entries=10)
+def _to_csv(df):
+    """CSV export bytes: no XML formatting, so far faster than Excel for large result sets.
+    The UTF-8 BOM makes Excel read non-ASCII headers such as the en dash correctly."""
+    return df.to_csv(index=False).encode("utf-8-sig")
 
 def format_inr(value):
     if value >= 1_000_000: return f"₹{value/1_000_000:.1f}M"
@@ -223,7 +414,10 @@ def format_inr(value):
 # ==============================================================================
 # 3. UI & THEME (CSS)
 # ==============================================================================
-st.markdown(f"""
+@st.cache_resource(show_spinner=False)  # Returns the same string object; cache_data would unpickle a copy
+def _css():
+    """Theme stylesheet, formatted once and reused on every rerun."""
+    return f"""
     <style>
         @import url('https://fonts.googleapis.com/css2?family=Montserrat:wght@300;400;500;600;700;800&display=swap');
         .stApp {{ background-color: {TRUST_BLUE}; font-family: 'Montserrat', sans-serif; color: #E6E6E6; }}
@@ -275,7 +469,7 @@ st.markdown(f"""
             border: 1px solid {SOLAR_RED};
         }}
     </style>
-""", unsafe_allow_html=True)
+"""
 
 # ==============================================================================
 # 4. SESSION STATE INITIALIZATION
@@ -290,7 +484,8 @@ if 'df' not in st.session_state:
 # ==============================================================================
 
 def main():
-    # --- Background & Header ---
+    # --- Theme, Background & Header ---
+    st.markdown(_css(), unsafe_allow_html=True)
     st.markdown('<div class="bg-shape-1"></div><div class="bg-shape-2"></div>', unsafe_allow_html=True)
     st.markdown(f"""
         <div class="solar-header animate-propel">
@@ -377,16 +572,43 @@ def render_dashboard_page():
     )
     st.markdown('</div>', unsafe_allow_html=True)
     
-    # --- DOWNLOAD BUTTON ---
-    buffer = io.BytesIO()
-    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False, sheet_name='ShippingBills')
-    st.download_button(
+    # --- DOWNLOAD BUTTONS ---
+    d1, d2 = st.columns([1, 1])
+    d1.download_button(
         label="Download as Excel",
-        data=buffer.getvalue(),
+        data=_to_xlsx(df),
         file_name="Solar_SB_Export.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
+    d2.download_button(
+        label="Download as CSV",
+        data=_to_csv(df),
+        file_name="Solar_SB_Export.csv",
+        mime="text/csv"
+    )
+
+def _process_batch(pdf_shas, texts, on_chunk=None):
+    """Extracts and flattens a batch of PDFs in one AI call, falling back to one call per
+    file if the batched response can't be used. Runs on a worker thread."""
+    # Each stream counts from zero: report a running total over the batch's streams so progress never drops
+    base, last = 0, 0
+    def report(n):
+        nonlocal last
+        last = n
+        if on_chunk: on_chunk(base + n)
+
+    documents = get_hierarchical_json_batch(texts, report) if len(texts) > 1 else None
+    if documents is not None:
+        # Cache each document under its own digest, so it is reused alone or in any other batch
+        for pdf_sha, document in zip(pdf_shas, documents):
+            _extract_cached(pdf_sha, EXTRACTION_VERSION, _document=document)
+    else:
+        documents = []
+        for pdf_sha, text in zip(pdf_shas, texts):
+            base, last = base + last, 0
+            try: documents.append(_extract_cached(pdf_sha, EXTRACTION_VERSION, _text=text, _on_chunk=report))
+            except ValueError: documents.append(None)
+    return [flatten_to_excel_rows(d) if _is_document(d) else None for d in documents]
 
 def process_files(uploaded_files):
     """The main logic to extract, process, and store data."""
@@ -395,27 +617,57 @@ def process_files(uploaded_files):
         return
 
     with st.spinner("Engaging AI Core... This may take a moment."):
-        all_data = []
         bar = st.progress(0, text="Initializing...")
 
-        for i, f in enumerate(uploaded_files):
-            progress_text = f"Processing file {i+1}/{len(uploaded_files)}: {f.name}"
-            bar.progress((i) / len(uploaded_files), text=progress_text)
-            
-            text = extract_pdf_text(f.read())
-            if text:
-                json_data = get_hierarchical_json(text)
-                if json_data:
-                    rows = flatten_to_excel_rows(json_data)
-                    all_data.extend(rows)
+        # Streamlit uploader objects aren't thread-safe (and .read() is empty after the first call):
+        # read and hash each file exactly once here. Identical uploads are processed only once.
+        blobs = [f.read() for f in uploaded_files]
+        shas = [hashlib.sha256(b).hexdigest() for b in blobs]
+        blob_by_sha = dict(zip(shas, blobs))
+        total = len(blob_by_sha)
+        rows_by_sha = {}
+
+        # Workers get this run's script context so st.error() inside them still reaches the page.
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_WORKERS, total),
+            initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+        ) as pool:
+            bar.progress(0, text=f"Reading {total} PDF files...")
+            # Texts come from the cache or worker processes; each AI batch (network-bound, thread pool)
+            # is submitted as soon as enough PDFs have been parsed to fill it.
+            parsed = extract_pdf_texts(blob_by_sha)
+            # Workers only record streamed AI output here (touching st.* inside the cached
+            # extraction would break cache replay); this thread renders it on the bar.
+            received, futures = {}, {}
+            # Only PDFs without a cached AI result are batched
+            for b, batch in enumerate(_group_batches(_skip_cached(parsed, rows_by_sha))):
+                batch_shas, batch_texts = zip(*batch)
+                received[b] = 0
+                future = pool.submit(
+                    _process_batch, list(batch_shas), list(batch_texts),
+                    lambda n, b=b: received.__setitem__(b, n)
+                )
+                futures[future] = batch_shas
+                bar.progress(0, text=f"Reading PDF files · {len(futures)} AI batch(es) started...")
+            pending, done = set(futures), total - sum(len(batch_shas) for batch_shas in futures.values())
+            while pending:
+                finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    batch_shas = futures[future]
+                    rows_by_sha.update(zip(batch_shas, future.result()))
+                    done += len(batch_shas)
+                bar.progress(done / total, text=f"Processed {done}/{total} files · receiving AI output ({sum(received.values()):,} chars)...")
+
+        # Keep rows in upload order regardless of completion order (duplicates repeat their rows)
+        results = [rows_by_sha.get(sha) for sha in shas]
+        all_data = [rows for rows in results if rows is not None and not rows.empty]
         
         bar.progress(1.0, text="Finalizing data...")
 
         if all_data:
-            df = pd.DataFrame(all_data)
-            safe_columns = [c for c in FINAL_COLUMNS if c in df.columns]
-            df = df[safe_columns]
-            df["Sr. No."] = range(1, len(df) + 1)
+            # Every frame is already laid out as FINAL_COLUMNS, so no reindex pass is needed
+            df = pd.concat(all_data, ignore_index=True)
+            df["Sr. No."] = np.arange(1, len(df) + 1, dtype=np.int32)
             
             st.session_state.df = df
             st.session_state.show_dashboard = True